@@ -1,12 +1,23 @@
 import logging
 import os
 import re
-from tempfile import mkdtemp
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache
+from itertools import islice
+from pathlib import Path
+from tempfile import TemporaryDirectory
 import asyncio
+import hashlib
 
 from dotenv import load_dotenv
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Message
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaAudio, InputMediaVideo, Message
 from telegram.ext import (
+    AIORateLimiter,
     Application,
     CommandHandler,
     MessageHandler,
@@ -15,10 +26,22 @@ from telegram.ext import (
     ContextTypes,
 )
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
 from typing import cast
+from urllib.parse import urlparse, parse_qs
 
 from yt_dlp import YoutubeDL
-from yt_dlp.utils import DownloadError
+from yt_dlp.utils import DownloadError, DownloadCancelled
+
+try:
+    from itertools import batched
+except ImportError:  # Python < 3.12
+    def batched(iterable, n):
+        """Yield successive n-sized tuples from iterable"""
+        it = iter(iterable)
+        while batch := tuple(islice(it, n)):
+            yield batch
 
 # Load environment variables from .env file
 load_dotenv()
@@ -36,9 +59,267 @@ TOKEN = os.getenv("BOT_TOKEN")
 # Local Bot API Server URL (Important!)
 LOCAL_API_SERVER = "http://localhost:8081/bot"  # Change to your local API server address
 
+# Where downloads are written; uploads are passed to the local server as file:// paths,
+# so this must be readable by the telegram-bot-api process (system temp dir if unset)
+DOWNLOAD_DIR = os.getenv("DOWNLOAD_DIR") or None
+
+# Public HTTPS URL Telegram pushes updates to (needs the webhooks extra, see requirements.txt);
+# the bot long-polls getUpdates when unset. The listener serves the URL's path on WEBHOOK_PORT.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL") or None
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or None  # Checked against each request's secret header
+
+# RAM-backed tmpfs (e.g. /dev/shm) for audio downloads when DOWNLOAD_DIR is not set; opt-in,
+# since the telegram-bot-api process must be able to see it (not the case across containers)
+TMPFS_DIR = os.getenv("TMPFS_DIR") or None
+
 # Constants
 MAX_FILE_SIZE = 2000 * 1024 * 1024  # 2000MB with local API server
-DOWNLOAD_BATCH_SIZE = 5  # Download and send videos in batches of 5
+DOWNLOAD_BATCH_SIZE = 5  # Queued downloads per playlist, so one big playlist cannot starve other chats
+MEDIA_GROUP_SIZE = 10  # Playlist files sent per album, Telegram allows up to 10
+MEDIA_GROUP_MAX_SIZE = MAX_FILE_SIZE  # Finished bytes held back for an album before sending early
+MEDIA_GROUP_WAIT = 30  # Seconds without a new finished download before a partial album is sent
+YDL_MAX_WORKERS = 8  # Concurrent blocking yt-dlp metadata calls
+DOWNLOAD_WORKERS = 8  # Downloads running at once across all users and chats
+CLEANUP_WORKERS = 2  # Temp dirs being removed at once
+DEFAULT_RESOLUTIONS = [2160, 1440, 1080, 720, 480]  # Offered when no formats are reported
+OUTPUT_TEMPLATE = "%(title)s.%(ext)s"  # yt-dlp file name inside each download's temp dir
+INFO_CACHE_SIZE = 512  # Video/playlist metadata entries kept in memory
+INFO_CACHE_TTL = 600  # Seconds before cached metadata is fetched again
+THUMB_CACHE_SIZE = 2048  # Thumbnail URL -> Telegram file_id entries kept in memory
+CHAT_URL_CACHE_SIZE = 64  # Video/playlist URLs remembered per chat for inline buttons
+CHAT_URL_TTL = 24 * 3600  # Seconds an inline button keeps working
+TITLE_FETCH_CONCURRENCY = 8  # Parallel lookups for playlist entries missing a title
+PROGRESS_EDIT_INTERVAL = 0.8  # Minimum seconds between progress edits of one message
+PROGRESS_EDIT_RETRIES = 3  # Times a failed progress edit is retried without a newer update
+
+# Per-item progress lines, filled in with the item's progress label
+STATUS_DOWNLOADING = "Downloading %s..."
+STATUS_WAITING = "Downloaded %s, waiting to send..."
+STATUS_UPLOADING = "Uploading %s (%.1fMB)..."
+STATUS_COMPLETED = "✅ Completed %s"
+STATUS_CANCELED = "🚫 Canceled %s"
+STATUS_FAILED = "❌ Failed %s: %.50s"
+
+# YouTube URL validation: accepted hosts, path prefixes followed by a video ID, and the ID itself
+YOUTUBE_HOSTS = {"youtube.com", "youtube-nocookie.com", "youtu.be"}
+YOUTUBE_ID_PATHS = ("/embed/", "/live/", "/v/", "/shorts/")
+VIDEO_ID_RE = re.compile(r'[\w\-]{11}')
+
+# Persistent yt-dlp cache directory (player JS, signature functions)
+YTDLP_CACHE_DIR = os.getenv("YTDLP_CACHE_DIR", "/var/cache/ytdlp-bot")
+
+# yt-dlp options for metadata extraction, one profile per use case
+INFO_YDL_OPTS = {
+    "video": {
+        "quiet": True,
+        "no_warnings": True,
+        "ignoreerrors": False,
+        "extract_flat": False,
+        "skip_download": True,
+        "writeinfojson": False,
+        "noplaylist": True,
+        "cachedir": YTDLP_CACHE_DIR,
+        # yt-dlp's default clients and manifests: the quality menu lists the formats this
+        # returns, and downloads pick their format from the same cached info dict, so this
+        # must stay a full extraction (no pinned client, no skipped DASH/HLS)
+    },
+    "playlist": {
+        "quiet": True,
+        "no_warnings": True,
+        "ignoreerrors": False,
+        "extract_flat": True,  # Don't download, just get info
+        "skip_download": True,
+        "noplaylist": False,  # Process as playlist
+        "cachedir": YTDLP_CACHE_DIR,
+    },
+}
+
+# Download through aria2c with parallel connections when it is installed. yt-dlp does not call
+# progress hooks while an external downloader runs, so /cancel only takes effect once aria2c has
+# finished the current file (it still skips merging, post-processing and the upload)
+if shutil.which("aria2c"):
+    DOWNLOADER_OPTS = {
+        "external_downloader": {"default": "aria2c"},
+        "external_downloader_args": {"aria2c": ["-x", "16", "-s", "16", "-k", "1M", "--console-log-level=warn"]},
+    }
+else:
+    DOWNLOADER_OPTS = {}
+
+# Bounded worker pool for blocking yt-dlp metadata calls, keeps the event loop free
+_ydl_executor = ThreadPoolExecutor(max_workers=YDL_MAX_WORKERS, thread_name_prefix="ytdlp")
+
+# Downloads get their own threads, one per download worker, so minutes-long downloads never
+# leave new links waiting on "Fetching information..." behind them
+_download_executor = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS, thread_name_prefix="download")
+
+# YoutubeDL instances are kept per worker thread and reused across requests
+_ydl_local = threading.local()
+
+# Download jobs shared by every chat, drained in order by DOWNLOAD_WORKERS workers
+_download_queue = asyncio.Queue()
+
+# Finished temp dirs, removed by CLEANUP_WORKERS workers off the send path
+_cleanup_queue = asyncio.Queue()
+
+# Threads reserved for deleting temp dirs, so disk-heavy removals never hold up the default
+# executor that asyncio.to_thread and DNS lookups share
+_cleanup_executor = ThreadPoolExecutor(max_workers=CLEANUP_WORKERS, thread_name_prefix="cleanup")
+
+# Background worker tasks, started and stopped with the Application
+_workers = []
+
+
+class TTLCache:
+    """Small LRU cache whose entries optionally expire after ttl seconds"""
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        expires, value = item
+        if expires is not None and expires < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def pop(self, key, default=None):
+        value = self.get(key, default)
+        self._data.pop(key, None)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __getitem__(self, key):
+        value = self.get(key, self)
+        if value is self:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        self._data[key] = (expires, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+
+@dataclass(slots=True)
+class VideoMeta:
+    """The few fields of a yt-dlp info dict the bot actually uses"""
+    title: str
+    uploader: str
+    duration: int
+    width: int
+    height: int
+    thumbnail: str
+    is_live: bool
+
+    @classmethod
+    def from_info(cls, info, default_title="Unknown Title"):
+        return cls(
+            title=info.get("title") or default_title,
+            uploader=info.get("uploader") or "Unknown",
+            duration=int(info.get("duration") or 0),
+            width=int(info.get("width") or 0),
+            height=int(info.get("height") or 0),
+            thumbnail=info.get("thumbnail") or "",
+            is_live=bool(info.get("is_live")),
+        )
+
+
+@dataclass(slots=True)
+class DownloadedFile:
+    """A finished download waiting to be sent, cleanup() removes its temp dir in the background"""
+    path: str
+    size: int
+    meta: VideoMeta
+    temp: TemporaryDirectory
+
+    def cleanup(self):
+        cleanup_in_background(self.temp)
+
+
+class ProgressMessage:
+    """Per-item status lines of one Telegram message, kept locally and flushed with debounced edits"""
+
+    def __init__(self, message, header):
+        self.message = message
+        self.header = header
+        self.lines = {}  # progress label -> status line, in insertion order
+        self._pending = None
+        self._shown = None
+        self._last_edit = 0.0
+        self._retries = 0
+
+    def update(self, label, line):
+        """Set the status line for a label and schedule an edit"""
+        self.lines[label] = line
+        if self._pending is None:
+            # Edit right away if the last edit is old enough, otherwise collect changes into one trailing edit
+            delay = self._last_edit + PROGRESS_EDIT_INTERVAL - time.monotonic()
+            self._pending = asyncio.create_task(self._flush_later(max(delay, 0.0)))
+
+    async def _flush_later(self, delay):
+        await asyncio.sleep(delay)
+        self._pending = None
+        await self.flush()
+
+    async def flush(self):
+        """Edit the message now with the current state, if it changed"""
+        if self._pending is not None:
+            self._pending.cancel()
+            self._pending = None
+        text = "\n".join([self.header, *self.lines.values()])
+        if text == self._shown:
+            return
+        self._shown = text
+        self._last_edit = time.monotonic()
+        try:
+            await edit_status_message(self.message, text)
+            self._retries = 0
+        except RetryAfter as e:
+            # Still flooded after the rate limiter's retries, show the text once the wait is over
+            logger.warning(f"Progress message not updated: {e}")
+            self._retry(e.retry_after)
+        except BadRequest as e:
+            # Permanent (message deleted, not editable), a subclass of NetworkError so caught first
+            logger.error(f"Error updating progress message: {e}")
+        except NetworkError as e:
+            logger.warning(f"Progress message not updated: {e}")
+            self._retry(PROGRESS_EDIT_INTERVAL)
+        except TelegramError as e:
+            # Forbidden and the like: never let them escape the fire-and-forget flush tasks
+            logger.error(f"Error updating progress message: {e}")
+
+    def _retry(self, delay):
+        """Schedule another edit with the current state after a failed one"""
+        self._shown = None
+        self._retries += 1
+        if self._pending is None and self._retries <= PROGRESS_EDIT_RETRIES:
+            self._pending = asyncio.create_task(self._flush_later(delay))
+
+    async def finish(self, text):
+        """Replace the message with a final text, dropping any pending progress edit"""
+        self.header = text
+        self.lines.clear()
+        await self.flush()
+
+
+# Video and playlist metadata keyed by (profile, URL), so repeated links and
+# playlist button clicks skip extraction
+_info_cache = TTLCache(INFO_CACHE_SIZE, INFO_CACHE_TTL)
+
+# Telegram file_id of thumbnails already sent, keyed by thumbnail URL
+_thumb_id_cache = TTLCache(THUMB_CACHE_SIZE)
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -75,11 +356,14 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handler to cancel ongoing downloads"""
-    user_id = update.effective_user.id
-    if 'download_task' in context.chat_data:
-        context.chat_data['download_task'].cancel()
-        context.chat_data['download_task'] = None
-        await update.message.reply_text("Download canceled.")
+    downloads = context.chat_data.get('downloads')
+    if downloads:
+        # Canceling a task also stops its yt-dlp workers through their cancel events
+        for task in list(downloads):
+            task.cancel()
+        await update.message.reply_text(
+            "Download canceled." if len(downloads) == 1 else f"{len(downloads)} downloads canceled."
+        )
     else:
         await update.message.reply_text("No active download to cancel.")
 
@@ -88,10 +372,9 @@ async def handle_url(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handler for YouTube URLs"""
     url = update.message.text
 
-    # YouTube URL validation with comprehensive regex
-    if not re.match(
-            r'^((?:https?:)?//)?((?:www|m)\.)?(youtube(-nocookie)?\.com|youtu.be)(/(?:[\w\-]+\?v=|embed/|live/|v/|playlist\?list=)?)([\w\-]+)(\S+)?$',
-            url):
+    # Validate the YouTube URL, a cheap substring check rejects plain chat before parsing
+    parsed = parse_youtube_url(url) if url and "youtu" in url[:32] else None
+    if not parsed:
         await update.message.reply_text("Please send a valid YouTube URL.")
         return
 
@@ -99,8 +382,8 @@ async def handle_url(update: Update, context: ContextTypes.DEFAULT_TYPE):
     status_message = cast(Message, await update.message.reply_text("⏳ Fetching information..."))
 
     try:
-        # Check if this is a playlist URL
-        if "playlist" in url or "list=" in url:
+        # Check if this is a playlist URL (only the query string is scanned)
+        if "list=" in parsed.query:
             await handle_playlist(update, context, url, status_message)
             return
 
@@ -120,65 +403,50 @@ async def handle_playlist(update: Update, context: ContextTypes.DEFAULT_TYPE, ur
     msg = cast(Message, status_message)
     await msg.edit_text("⏳ Fetching playlist information...")
 
-    # Store the URL in context.chat_data with a unique ID
-    url_id = str(hash(url) % 10000)  # Create a short unique ID
-    if 'urls' not in context.chat_data:
-        context.chat_data['urls'] = {}
-    context.chat_data['urls'][url_id] = url
+    url_id = register_url(context, url)
 
     try:
-        # Configure YoutubeDL to extract playlist information
-        ydl_opts = {
-            "quiet": True,
-            "no_warnings": True,
-            "ignoreerrors": False,
-            "extract_flat": True,  # Don't download, just get info
-            "skip_download": True,
-            "noplaylist": False,  # Process as playlist
-        }
-
         # Get playlist info
-        with YoutubeDL(ydl_opts) as ydl:
-            playlist_info = ydl.extract_info(url, download=False)
+        playlist_info = await cached_extract(url, "playlist")
 
-            if not playlist_info:
-                await status_message.edit_text("❌ Could not fetch playlist information.")
-                return
-
-            # Extract playlist details
-            playlist_title = playlist_info.get('title', 'Unknown Playlist')
-            entries = playlist_info.get('entries', [])
-
-            if not entries:
-                await status_message.edit_text("❌ This playlist is empty or private.")
-                return
+        if not playlist_info:
+            await status_message.edit_text("❌ Could not fetch playlist information.")
+            return
 
-            # Check the number of videos in the playlist
-            video_count = len(entries)
+        # Extract playlist details
+        playlist_title = playlist_info.get('title', 'Unknown Playlist')
+        entries = playlist_info.get('entries', [])
 
-            # Create buttons for playlist options
-            buttons = [
-                [InlineKeyboardButton(f"Download All ({video_count} videos)",
-                                      callback_data=f"playlist_all_{url_id}")],
-                [InlineKeyboardButton("Select Individual Videos",
-                                      callback_data=f"playlist_select_{url_id}")],
-                [InlineKeyboardButton("First 5 Videos Only",
-                                      callback_data=f"playlist_first5_{url_id}")],
-                [InlineKeyboardButton("Audio Only (All Videos)",
-                                      callback_data=f"playlist_audio_{url_id}")]
-            ]
-
-            # Create keyboard for playlist options
-            keyboard = InlineKeyboardMarkup(buttons)
+        if not entries:
+            await status_message.edit_text("❌ This playlist is empty or private.")
+            return
 
-            # Send playlist information
-            await status_message.edit_text(
-                f"*Playlist: {playlist_title}*\n\n"
-                f"Videos: {video_count}\n"
-                f"Choose download option:",
-                reply_markup=keyboard,
-                parse_mode=ParseMode.MARKDOWN
-            )
+        # Check the number of videos in the playlist
+        video_count = len(entries)
+
+        # Create buttons for playlist options
+        buttons = [
+            [InlineKeyboardButton(f"Download All ({video_count} videos)",
+                                  callback_data=f"playlist_all_{url_id}")],
+            [InlineKeyboardButton("Select Individual Videos",
+                                  callback_data=f"playlist_select_{url_id}")],
+            [InlineKeyboardButton("First 5 Videos Only",
+                                  callback_data=f"playlist_first5_{url_id}")],
+            [InlineKeyboardButton("Audio Only (All Videos)",
+                                  callback_data=f"playlist_audio_{url_id}")]
+        ]
+
+        # Create keyboard for playlist options
+        keyboard = InlineKeyboardMarkup(buttons)
+
+        # Send playlist information
+        await status_message.edit_text(
+            f"*Playlist: {playlist_title}*\n\n"
+            f"Videos: {video_count}\n"
+            f"Choose download option:",
+            reply_markup=keyboard,
+            parse_mode=ParseMode.MARKDOWN
+        )
 
     except Exception as e:
         logger.error(f"Error processing playlist: {e}")
@@ -188,130 +456,114 @@ async def handle_playlist(update: Update, context: ContextTypes.DEFAULT_TYPE, ur
 async def process_single_video(update: Update, context: ContextTypes.DEFAULT_TYPE, url, status_message):
     """Process a single video URL"""
     try:
-        # Configure YoutubeDL to extract video information
-        ydl_opts = {
-            "quiet": True,
-            "no_warnings": True,
-            "ignoreerrors": False,
-            "extract_flat": False,
-            "skip_download": True,
-            "format": "best",
-            "writeinfojson": False,
-            "noplaylist": True,
-        }
+        info = await cached_extract(url, "video")
 
-        with YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
+        if not info:
+            await status_message.edit_text("❌ Could not fetch video information.")
+            return
 
-            if not info:
-                await status_message.edit_text("❌ Could not fetch video information.")
-                return
+        meta = VideoMeta.from_info(info)
 
-            # Check if the video is a livestream
-            if info.get("is_live", False):
-                await status_message.edit_text("❌ Cannot download live streams.")
-                return
+        # Check if the video is a livestream
+        if meta.is_live:
+            await status_message.edit_text("❌ Cannot download live streams.")
+            return
 
-            # Get available formats with video and audio
-            formats = [
-                f for f in info.get("formats", [])
-                if f.get("vcodec") != "none" and f.get("acodec") != "none" and f.get("height")
-            ]
-
-            # If no combined formats, look for separate video and audio formats
-            if not formats:
-                video_formats = [
-                    f for f in info.get("formats", [])
-                    if f.get("vcodec") != "none" and f.get("height") and f.get("height") >= 480
-                ]
+        # Single pass over the formats, keeping (filesize, format_id, ext) of the largest
+        # format per resolution, separately for combined and video-only streams
+        combined, video_only = {}, {}
+        for f in info.get("formats") or ():
+            height = f.get("height") or 0
+            if not 480 <= height <= 2160 or f.get("vcodec") == "none":  # Filter to reasonable resolutions
+                continue
+            candidates = video_only if f.get("acodec") == "none" else combined
+            filesize = f.get("filesize") or 0
+            current = candidates.get(height)
+            if current is None or filesize > current[0]:
+                candidates[height] = (filesize, f.get("format_id"), f.get("ext"))
+
+        # Prefer combined formats, otherwise let yt-dlp merge separate video and audio
+        best = combined or video_only
+
+        # Debug output for format inspection
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Available resolutions: %d", len(best))
+            for height, (filesize, format_id, ext) in list(best.items())[:5]:  # Log first 5 for debugging
+                logger.debug("Format: %s - %sp - %s", format_id, height, ext)
+
+        # Telegram limits callback_data to 64 bytes, so buttons carry a short ID instead of the URL
+        url_id = register_url(context, url)
+
+        # Create quality selection buttons (highest resolution first)
+        buttons = []
+        for height in sorted(best, reverse=True):
+            res = f"{height}p"
+            file_size_mb = best[height][0] / (1024 * 1024)
+            if file_size_mb > 0:
+                label = f"{res} (~{file_size_mb:.1f}MB)"
+            else:
+                label = res
+            buttons.append(
+                InlineKeyboardButton(label, callback_data=f"q|{height}|{url_id}")
+            )
 
-                if video_formats:
-                    formats = video_formats  # We'll use these and let yt-dlp handle merging
+        # If no buttons were created (no proper video formats found), offer common resolutions
+        if not buttons:
+            logger.warning("No video formats detected from the API, using default resolutions")
+            for res in DEFAULT_RESOLUTIONS:
+                buttons.append(
+                    InlineKeyboardButton(f"{res}p", callback_data=f"q|{res}|{url_id}")
+                )
 
-            # Debug output for format inspection
-            logger.info(f"Available formats: {len(formats)}")
-            for f in formats[:5]:  # Log first 5 formats for debugging
-                logger.info(f"Format: {f.get('format_id')} - {f.get('height')}p - {f.get('ext')}")
+        # Add a button for audio only
+        buttons.append(
+            InlineKeyboardButton("Audio Only", callback_data=f"q|audio|{url_id}")
+        )
 
-            # Create quality selection buttons
-            buttons = []
-            unique_resolutions = set()
-
-            # Sort formats by resolution (highest first)
-            for f in sorted(formats, key=lambda x: (x.get("height", 0) or 0), reverse=True):
-                height = f.get("height", 0)
-                if 480 <= height <= 2160:  # Filter to reasonable resolutions
-                    res = f"{height}p"
-                    if res not in unique_resolutions:
-                        unique_resolutions.add(res)
-                        file_size_mb = f.get("filesize", 0) / (1024 * 1024)
-                        if file_size_mb > 0:
-                            label = f"{res} (~{file_size_mb:.1f}MB)"
-                        else:
-                            label = res
-                        buttons.append(
-                            InlineKeyboardButton(label, callback_data=f"quality|{height}|{url}")
-                        )
-
-            # If no buttons were created (no proper video formats found), offer common resolutions
-            if not buttons:
-                logger.warning("No video formats detected from the API, using default resolutions")
-                for res in [1080, 720, 480]:
-                    buttons.append(
-                        InlineKeyboardButton(f"{res}p", callback_data=f"quality|{res}|{url}")
-                    )
-
-            # Add a button for audio only
-            buttons.append(
-                InlineKeyboardButton("Audio Only", callback_data=f"quality|audio|{url}")
-            )
+        # Arrange buttons in rows of 2
+        keyboard = InlineKeyboardMarkup(list(batched(buttons, 2)))
 
-            # Arrange buttons in rows of 2
-            keyboard = InlineKeyboardMarkup([buttons[i:i + 2] for i in range(0, len(buttons), 2)])
+        thumbnail_url = meta.thumbnail
 
-            # Get thumbnail URL
-            thumbnail_url = info.get("thumbnail", "")
-            video_title = info.get("title", "Unknown Title")
-            uploader = info.get("uploader", "Unknown")
-            duration = info.get("duration", 0)
+        # Build the caption once for both the photo and the text-only message
+        caption = (
+            f"*{meta.title}*\n\n"
+            f"Duration: {format_duration(meta.duration)}\n"
+            f"Channel: {meta.uploader}\n\n"
+            "Select video quality:"
+        )
 
-            # First try to send with thumbnail
-            try:
-                if thumbnail_url:
-                    # Send the thumbnail with video information
-                    await context.bot.send_photo(
-                        chat_id=update.effective_chat.id,
-                        photo=thumbnail_url,
-                        caption=f"*{video_title}*\n\n"
-                                f"Duration: {format_duration(duration)}\n"
-                                f"Channel: {uploader}\n\n"
-                                "Select video quality:",
-                        reply_markup=keyboard,
-                        parse_mode=ParseMode.MARKDOWN
-                    )
-                    await status_message.delete()
-                else:
-                    # Fallback to text only if no thumbnail
-                    await status_message.edit_text(
-                        f"*{video_title}*\n\n"
-                        f"Duration: {format_duration(duration)}\n"
-                        f"Channel: {uploader}\n\n"
-                        "Select video quality:",
-                        reply_markup=keyboard,
-                        parse_mode=ParseMode.MARKDOWN
-                    )
-            except Exception as e:
-                logger.error(f"Error sending thumbnail: {e}")
-                # Fallback to text only
-                msg = cast(Message, status_message)
-                await msg.edit_text(
-                    f"*{video_title}*\n\n"
-                    f"Duration: {format_duration(duration)}\n"
-                    f"Channel: {uploader}\n\n"
-                    "Select video quality:",
-                    reply_markup=keyboard,
-                    parse_mode=ParseMode.MARKDOWN
-                )
+        async def send_menu(with_photo):
+            """Send the quality menu, with the thumbnail if requested"""
+            if not with_photo:
+                await status_message.edit_text(caption, reply_markup=keyboard, parse_mode=ParseMode.MARKDOWN)
+                return
+
+            # Send the thumbnail with video information, reusing the file_id for repeat videos
+            photo_message = await context.bot.send_photo(
+                chat_id=update.effective_chat.id,
+                photo=_thumb_id_cache.get(thumbnail_url, thumbnail_url),
+                caption=caption,
+                reply_markup=keyboard,
+                parse_mode=ParseMode.MARKDOWN
+            )
+            if photo_message.photo:
+                _thumb_id_cache[thumbnail_url] = photo_message.photo[-1].file_id
+            await status_message.delete()
+
+        # First try to send with thumbnail, fall back to text only
+        try:
+            await send_menu(bool(thumbnail_url))
+        except BadRequest as e:
+            # Telegram could not fetch or accept the thumbnail; a cached file_id may have gone
+            # stale, so the next menu for it starts from the URL again
+            logger.error(f"Error sending thumbnail: {e}")
+            _thumb_id_cache.pop(thumbnail_url, None)
+            await send_menu(False)
+        except NetworkError as e:
+            # Timed out while Telegram was fetching the thumbnail
+            logger.error(f"Error sending thumbnail: {e}")
+            await send_menu(False)
 
     except Exception as e:
         logger.error(f"Error processing video: {e}")
@@ -324,12 +576,15 @@ async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_T
     callback_data = query.data
 
     # Handle different callback formats
-    if callback_data.startswith("quality|"):
+    if callback_data.startswith("q|"):
         # Single video quality selection
         parts = callback_data.split('|')
-        quality = parts[1]
-        url = parts[2]
-        await handle_quality_selection(update, context, quality, url)
+        quality, url_id = parts[1], parts[2]
+        url = context.chat_data.get('urls', {}).get(url_id)
+        if url:
+            await handle_quality_selection(update, context, quality, url)
+        else:
+            await query.answer("This link has expired. Please send it again.")
     elif callback_data.startswith("playlist_"):
         # Playlist actions - handle with underscores instead of pipes
         parts = callback_data.split('_')
@@ -359,6 +614,7 @@ async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_T
     else:
         await query.answer("Unknown action")
 
+
 async def handle_playlist_action(update: Update, context: ContextTypes.DEFAULT_TYPE, action, url):
     """Handle playlist download actions"""
     query = update.callback_query
@@ -369,223 +625,292 @@ async def handle_playlist_action(update: Update, context: ContextTypes.DEFAULT_T
     await message.edit_text(f"⏳ Processing playlist action: {action}...")
 
     try:
-        # Configure YoutubeDL to extract playlist information
-        ydl_opts = {
-            "quiet": True,
-            "no_warnings": True,
-            "ignoreerrors": False,
-            "extract_flat": True,  # Don't download, just get info
-            "skip_download": True,
-            "noplaylist": False,  # Process as playlist
-        }
-
         # Get playlist info
-        with YoutubeDL(ydl_opts) as ydl:
-            playlist_info = ydl.extract_info(url, download=False)
+        playlist_info = await cached_extract(url, "playlist")
 
-            if not playlist_info:
-                await message.edit_text("❌ Could not fetch playlist information.")
-                return
+        if not playlist_info:
+            await message.edit_text("❌ Could not fetch playlist information.")
+            return
 
-            # Extract playlist details
-            playlist_title = playlist_info.get('title', 'Unknown Playlist')
-            entries = playlist_info.get('entries', [])
+        # Extract playlist details
+        playlist_title = playlist_info.get('title', 'Unknown Playlist')
+        entries = playlist_info.get('entries', [])
 
-            if not entries:
-                await message.edit_text("❌ This playlist is empty or private.")
-                return
+        if not entries:
+            await message.edit_text("❌ This playlist is empty or private.")
+            return
+
+        # Process based on action
+        if action == "all":
+            # Download all videos in playlist
+            video_count = len(entries)
+            header = (
+                f"⏳ Starting download of {video_count} videos from playlist: {playlist_title}\n\n"
+                "Videos will be sent in albums of up to 10 as they are downloaded."
+            )
+            progress = ProgressMessage(await message.edit_text(header), header)
 
-            # Process based on action
-            if action == "all":
-                # Download all videos in playlist
-                video_count = len(entries)
-                info_message = await message.edit_text(
-                    f"⏳ Starting download of {video_count} videos from playlist: {playlist_title}\n\n"
-                    "Videos will be sent as they are downloaded."
+            sent = await run_cancelable(
+                context, download_playlist_entries(context, chat_id, "720", entries, progress)  # Default to 720p
+            )
+
+            if sent is None:
+                await progress.finish(f"🚫 Playlist download canceled: {playlist_title}")
+            else:
+                await progress.finish(
+                    f"✅ Playlist download complete: {playlist_title} ({sent}/{video_count} sent)"
                 )
 
-                # Process videos in batches to prevent memory issues
-                for batch_start in range(0, video_count, DOWNLOAD_BATCH_SIZE):
-                    batch_end = min(batch_start + DOWNLOAD_BATCH_SIZE, video_count)
-
-                    # Create tasks for concurrent downloads
-                    download_tasks = []
-                    for idx in range(batch_start, batch_end):
-                        entry = entries[idx]
-                        if not entry:
-                            continue
-
-                        video_id = entry.get('id')
-                        video_url = f"https://www.youtube.com/watch?v={video_id}"
-
-                        # Submit download task
-                        task = asyncio.create_task(
-                            download_and_send_video(
-                                context,
-                                chat_id,
-                                "720",  # Default to 720p
-                                video_url,
-                                f"[{idx + 1}/{video_count}]",
-                                info_message
-                            )
-                        )
-                        download_tasks.append(task)
-
-                    # Wait for all tasks in batch to complete
-                    if download_tasks:
-                        await info_message.edit_text(
-                            f"⏳ Downloading batch {batch_start // DOWNLOAD_BATCH_SIZE + 1} of "
-                            f"{(video_count - 1) // DOWNLOAD_BATCH_SIZE + 1} from playlist: {playlist_title}\n\n"
-                            f"Processing videos {batch_start + 1}-{batch_end} of {video_count}"
-                        )
-                        await asyncio.gather(*download_tasks)
-
-                await info_message.edit_text(f"✅ Playlist download complete: {playlist_title}")
-
-            elif action == "first5":
-                # Download first 5 videos
-                limit = min(5, len(entries))
-                info_message = await message.edit_text(
-                    f"⏳ Starting download of first {limit} videos from playlist: {playlist_title}\n\n"
-                    "Videos will be sent as they are downloaded."
+        elif action == "first5":
+            # Download first 5 videos
+            limit = min(5, len(entries))
+            header = (
+                f"⏳ Starting download of first {limit} videos from playlist: {playlist_title}\n\n"
+                "Videos will be sent in albums of up to 10 as they are downloaded."
+            )
+            progress = ProgressMessage(await message.edit_text(header), header)
+
+            sent = await run_cancelable(
+                context, download_playlist_entries(context, chat_id, "720", entries[:limit], progress)
+            )
+
+            if sent is None:
+                await progress.finish(f"🚫 Playlist download canceled: {playlist_title}")
+            else:
+                await progress.finish(
+                    f"✅ First {limit} videos downloaded from playlist: {playlist_title} ({sent}/{limit} sent)"
                 )
 
-                # Create tasks for concurrent downloads
-                download_tasks = []
-                for idx in range(limit):
-                    entry = entries[idx]
-                    if not entry:
-                        continue
-
-                    video_id = entry.get('id')
-                    video_url = f"https://www.youtube.com/watch?v={video_id}"
-
-                    # Submit download task
-                    task = asyncio.create_task(
-                        download_and_send_video(
-                            context,
-                            chat_id,
-                            "720",  # Default to 720p
-                            video_url,
-                            f"[{idx + 1}/{limit}]",
-                            info_message
-                        )
-                    )
-                    download_tasks.append(task)
-
-                # Wait for all tasks to complete
-                if download_tasks:
-                    await asyncio.gather(*download_tasks)
-
-                await info_message.edit_text(f"✅ First {limit} videos downloaded from playlist: {playlist_title}")
-
-            elif action == "audio":
-                # Download audio for all videos
-                video_count = len(entries)
-                info_message = await message.edit_text(
-                    f"⏳ Starting audio download for {video_count} videos from playlist: {playlist_title}\n\n"
-                    "Audio files will be sent as they are downloaded."
+        elif action == "audio":
+            # Download audio for all videos
+            video_count = len(entries)
+            header = (
+                f"⏳ Starting audio download for {video_count} videos from playlist: {playlist_title}\n\n"
+                "Audio files will be sent in albums of up to 10 as they are downloaded."
+            )
+            progress = ProgressMessage(await message.edit_text(header), header)
+
+            sent = await run_cancelable(
+                context, download_playlist_entries(context, chat_id, "audio", entries, progress)
+            )
+
+            if sent is None:
+                await progress.finish(f"🚫 Playlist download canceled: {playlist_title}")
+            else:
+                await progress.finish(
+                    f"✅ Playlist audio download complete: {playlist_title} ({sent}/{video_count} sent)"
                 )
 
-                # Process in batches to prevent memory issues
-                for batch_start in range(0, video_count, DOWNLOAD_BATCH_SIZE):
-                    batch_end = min(batch_start + DOWNLOAD_BATCH_SIZE, video_count)
-
-                    # Create tasks for concurrent downloads
-                    download_tasks = []
-                    for idx in range(batch_start, batch_end):
-                        entry = entries[idx]
-                        if not entry:
-                            continue
-
-                        video_id = entry.get('id')
-                        video_url = f"https://www.youtube.com/watch?v={video_id}"
-
-                        # Submit download task
-                        task = asyncio.create_task(
-                            download_and_send_video(
-                                context,
-                                chat_id,
-                                "audio",  # Audio only
-                                video_url,
-                                f"[{idx + 1}/{video_count}]",
-                                info_message
-                            )
-                        )
-                        download_tasks.append(task)
-
-                    # Wait for all tasks in batch to complete
-                    if download_tasks:
-                        await info_message.edit_text(
-                            f"⏳ Downloading audio batch {batch_start // DOWNLOAD_BATCH_SIZE + 1} of "
-                            f"{(video_count - 1) // DOWNLOAD_BATCH_SIZE + 1} from playlist: {playlist_title}\n\n"
-                            f"Processing audio {batch_start + 1}-{batch_end} of {video_count}"
-                        )
-                        await asyncio.gather(*download_tasks)
-
-                await info_message.edit_text(f"✅ Playlist audio download complete: {playlist_title}")
-
-            elif action == "select":
-                # Create a list of videos to select from
-                limit = min(30, len(entries))  # Limit selections to 30 for UI reasons
-                buttons = []
-
-                # Create buttons for each video
-                for idx, entry in enumerate(entries[:limit]):
-                    if not entry:
-                        continue
-
-                    video_id = entry.get('id')
-                    video_title = entry.get('title', f'Video {idx + 1}')
-
-                    # Create quality options for each video
-                    video_buttons = [
-                        [
-                            InlineKeyboardButton(f"{idx + 1}. {video_title[:20]}...",
-                                                 callback_data=f"video_info|{video_id}")
-                        ],
-                        [
-                            InlineKeyboardButton("720p", callback_data=f"playlist_video|{video_id}|720"),
-                            InlineKeyboardButton("480p", callback_data=f"playlist_video|{video_id}|480"),
-                            InlineKeyboardButton("Audio", callback_data=f"playlist_video|{video_id}|audio")
-                        ]
+        elif action == "select":
+            # Create a list of videos to select from
+            limit = min(30, len(entries))  # Limit selections to 30 for UI reasons
+            buttons = []
+
+            # Flat extraction sometimes returns bare IDs, look those titles up in parallel
+            missing = [entry for entry in entries[:limit] if entry and not entry.get('title')]
+            if missing:
+                await fill_missing_titles(missing)
+
+            # Create buttons for each video
+            for idx, entry in enumerate(entries[:limit]):
+                if not entry:
+                    continue
+
+                video_id = entry.get('id')
+                video_title = entry.get('title') or f'Video {idx + 1}'  # Flat entries carry 'title': None
+
+                # Create quality options for each video
+                video_buttons = [
+                    [
+                        InlineKeyboardButton(f"{idx + 1}. {video_title[:20]}...",
+                                             callback_data=f"video_info|{video_id}")
+                    ],
+                    [
+                        InlineKeyboardButton("720p", callback_data=f"playlist_video|{video_id}|720"),
+                        InlineKeyboardButton("480p", callback_data=f"playlist_video|{video_id}|480"),
+                        InlineKeyboardButton("Audio", callback_data=f"playlist_video|{video_id}|audio")
                     ]
+                ]
 
-                    buttons.extend(video_buttons)
+                buttons.extend(video_buttons)
 
-                # Create keyboard with videos
-                keyboard = InlineKeyboardMarkup(buttons)
+            # Create keyboard with videos
+            keyboard = InlineKeyboardMarkup(buttons)
 
-                await message.edit_text(
-                    f"*Select videos from playlist:* {playlist_title}\n\n"
-                    "Choose quality option for each video you want to download:",
-                    reply_markup=keyboard,
-                    parse_mode=ParseMode.MARKDOWN
-                )
+            await message.edit_text(
+                f"*Select videos from playlist:* {playlist_title}\n\n"
+                "Choose quality option for each video you want to download:",
+                reply_markup=keyboard,
+                parse_mode=ParseMode.MARKDOWN
+            )
 
     except Exception as e:
         logger.error(f"Error processing playlist action: {e}")
         await message.edit_text(f"❌ Error processing playlist. Please try again. Error: {str(e)[:100]}")
 
 
-async def download_and_send_video(context, chat_id, quality, url, progress_label, info_message=None):
-    """Download and send a single video or audio file"""
-    temp_dir = mkdtemp()
-    download_success = False
-    output_path = None
-    info = None
+async def fill_missing_titles(entries):
+    """Fetch titles for flat playlist entries that came without one"""
+    semaphore = asyncio.Semaphore(TITLE_FETCH_CONCURRENCY)
+
+    async def fetch_title(entry):
+        # Goes through the metadata cache, so reopening the list or downloading the video is free
+        async with semaphore:
+            info = await cached_extract(f"https://www.youtube.com/watch?v={entry.get('id')}", "video")
+        if info and info.get('title'):
+            entry['title'] = info['title']
+
+    results = await asyncio.gather(*(fetch_title(entry) for entry in entries), return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logger.warning(f"Could not fetch playlist entry title: {result}")
+
+
+async def download_playlist_entries(context, chat_id, quality, entries, progress):
+    """Download playlist entries with up to DOWNLOAD_BATCH_SIZE in flight and send them as albums, returns the number sent"""
+    semaphore = asyncio.Semaphore(DOWNLOAD_BATCH_SIZE)
+    total = len(entries)
+
+    async def download_entry(idx, entry):
+        # A new download starts as soon as any running one finishes, no waiting for a whole batch
+        progress_label = f"[{idx + 1}/{total}]"
+        async with semaphore:
+            video_url = f"https://www.youtube.com/watch?v={entry.get('id')}"
+            try:
+                return progress_label, await queue_download(quality, video_url, progress_label, progress)
+            except asyncio.CancelledError:
+                progress.update(progress_label, STATUS_CANCELED % progress_label)
+                raise
+            except Exception as e:
+                logger.error(f"Download error ({progress_label}): {e}")
+                progress.update(progress_label, STATUS_FAILED % (progress_label, e))
+                return progress_label, None
+
+    pending = {asyncio.create_task(download_entry(idx, entry)) for idx, entry in enumerate(entries) if entry}
+    ready = []  # (progress_label, DownloadedFile) pairs waiting to fill an album
+    sent = 0
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, timeout=MEDIA_GROUP_WAIT,
+                                               return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                progress_label, file = task.result()
+                if file:
+                    progress.update(progress_label, STATUS_WAITING % progress_label)
+                    ready.append((progress_label, file))
+
+            # Send a full album right away, and a partial one once the rest is slow to arrive,
+            # the playlist is done, or the files waiting on disk already add up to a large album
+            while ready and (len(ready) >= MEDIA_GROUP_SIZE or not done or not pending
+                             or sum(file.size for _, file in ready) >= MEDIA_GROUP_MAX_SIZE):
+                group, ready = ready[:MEDIA_GROUP_SIZE], ready[MEDIA_GROUP_SIZE:]
+                sent += await send_files(context, chat_id, quality, group, progress)
+    finally:
+        for task in pending:
+            # Downloads that finished after the last wait() were never collected, clean them up here
+            if task.done() and not task.cancelled() and task.result()[1]:
+                task.result()[1].cleanup()
+            task.cancel()
+        for _, file in ready:
+            file.cleanup()
+    return sent
+
+
+async def send_files(context, chat_id, quality, files, progress):
+    """Send downloaded files as one media group (a single file is sent on its own), returns the number sent"""
+    try:
+        for progress_label, file in files:
+            progress.update(progress_label, STATUS_UPLOADING % (progress_label, file.size / (1024 * 1024)))
+
+        if len(files) == 1:
+            progress_label, file = files[0]
+            await send_file(context, chat_id, quality, file, progress_label)
+        else:
+            # One sendMediaGroup call counts once against the rate limits, however many files it carries
+            media_type = InputMediaAudio if quality == "audio" else InputMediaVideo
+            await context.bot.send_media_group(
+                chat_id=chat_id,
+                media=[media_type(Path(file.path), **media_fields(quality, file, progress_label))
+                       for progress_label, file in files],
+            )
+
+        for progress_label, _ in files:
+            progress.update(progress_label, STATUS_COMPLETED % progress_label)
+        return len(files)
+    except Exception as e:
+        logger.error(f"Upload error: {e}")
+        for progress_label, _ in files:
+            progress.update(progress_label, STATUS_FAILED % (progress_label, e))
+        return 0
+    finally:
+        for _, file in files:
+            file.cleanup()
+
+
+def media_fields(quality, file, progress_label):
+    """Caption and metadata shared by send_audio/send_video and their InputMedia counterparts"""
+    meta = file.meta
+    if quality == "audio":
+        return {
+            "caption": f"{meta.title} {progress_label} (Audio)",
+            "title": meta.title,
+            "performer": meta.uploader,
+            "duration": meta.duration or None,
+        }
+
+    # Dimensions of the format yt-dlp actually downloaded, the server probes the file when unknown
+    return {
+        "caption": f"{meta.title} {progress_label} ({quality}p)",
+        "supports_streaming": True,
+        "duration": meta.duration or None,
+        "width": meta.width or None,
+        "height": meta.height or None,
+    }
+
+
+async def send_file(context, chat_id, quality, file, progress_label):
+    """Send one downloaded file as audio or video"""
+    # Send the file by path; in local mode it goes out as a file:// URI the server reads from disk
+    if quality == "audio":
+        await context.bot.send_audio(chat_id=chat_id, audio=Path(file.path),
+                                     **media_fields(quality, file, progress_label))
+    else:
+        await context.bot.send_video(chat_id=chat_id, video=Path(file.path),
+                                     **media_fields(quality, file, progress_label))
+
+
+async def download_file(quality, url, progress_label, progress=None, cancel_event=None):
+    """Download a single video or audio file into its own temp dir, the caller cleans it up"""
+    # Audio files are small enough for tmpfs, videos (up to 2GB) stay on disk
+    temp_parent = DOWNLOAD_DIR or (TMPFS_DIR if quality == "audio" else None)
+    # TemporaryDirectory removes the whole tree with one shutil.rmtree call, even if we crash;
+    # a file the local server still holds open must not turn cleanup into an exception
+    temp = TemporaryDirectory(prefix="ytbot_", dir=temp_parent, ignore_cleanup_errors=True)
+    temp_dir = temp.name
+    # mkdtemp creates the dir as 0700, open it up so a server running as another user can read the file
+    os.chmod(temp_dir, 0o755)
+    download_future = None
+    cancel_event = cancel_event or threading.Event()
+
+    def check_canceled(status):
+        """yt-dlp progress hook that aborts the download once canceled"""
+        if cancel_event.is_set():
+            raise DownloadCancelled()
 
     try:
         # Configure download options for improved speed
         if quality == "audio":
             ydl_opts = {
-                "format": "bestaudio/best",
-                "outtmpl": os.path.join(temp_dir, "%(title)s.%(ext)s"),
+                # Prefer AAC sources so extracting to m4a is a stream copy instead of a transcode
+                "format": "bestaudio[ext=m4a]/bestaudio/best",
+                "paths": {"home": temp_dir},
+                "outtmpl": OUTPUT_TEMPLATE,
                 "postprocessors": [{
                     "key": "FFmpegExtractAudio",
-                    "preferredcodec": "mp3",
-                    "preferredquality": "192",
+                    "preferredcodec": "m4a",
+                    "preferredquality": "2",  # VBR, used only when the source has to be re-encoded
                 }],
+                "postprocessor_args": {"extractaudio": ["-threads", "2"]},
                 "quiet": True,
                 "no_warnings": True,
                 "geo_bypass": True,
@@ -594,11 +919,17 @@ async def download_and_send_video(context, chat_id, quality, url, progress_label
                 "fragment_retries": 3,
                 "concurrent_fragment_downloads": 10,
                 "throttledratelimit": 100000,
+                "http_chunk_size": 10485760,  # Ranged 10MB requests avoid YouTube throttling
+                "cachedir": YTDLP_CACHE_DIR,
+                **DOWNLOADER_OPTS,
+                "progress_hooks": [check_canceled],
+                "postprocessor_hooks": [check_canceled],
             }
         else:
             ydl_opts = {
                 "format": f"bestvideo[height<={quality}]+bestaudio/best[height<={quality}]/best",
-                "outtmpl": os.path.join(temp_dir, "%(title)s.%(ext)s"),
+                "paths": {"home": temp_dir},
+                "outtmpl": OUTPUT_TEMPLATE,
                 "merge_output_format": "mp4",
                 "quiet": True,
                 "no_warnings": True,
@@ -608,93 +939,140 @@ async def download_and_send_video(context, chat_id, quality, url, progress_label
                 "fragment_retries": 3,
                 "concurrent_fragment_downloads": 10,
                 "throttledratelimit": 100000,
+                "http_chunk_size": 10485760,  # Ranged 10MB requests avoid YouTube throttling
+                "cachedir": YTDLP_CACHE_DIR,
+                **DOWNLOADER_OPTS,
+                "progress_hooks": [check_canceled],
+                "postprocessor_hooks": [check_canceled],
             }
 
-        # Update info message if provided
-        if info_message:
-            current_text = await get_message_text(info_message)
-            if not current_text.endswith(f"\nDownloading {progress_label}..."):
-                await update_info_message(info_message, f"{current_text}\nDownloading {progress_label}...")
-
-        # Download the video
-        with YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            video_title = info.get("title", "video")
-            download_success = True
-
-        # Find the downloaded file
-        downloaded_files = os.listdir(temp_dir)
-        if not downloaded_files:
-            raise Exception("No files were downloaded")
+        # Update progress message if provided
+        if progress:
+            progress.update(progress_label, STATUS_DOWNLOADING % progress_label)
+
+        # Download the video on the download thread pool
+        download_future = _download_executor.submit(download_sync, url, ydl_opts, _info_cache.get(("video", url)))
+        info = await asyncio.wrap_future(download_future)
 
-        output_path = os.path.join(temp_dir, downloaded_files[0])
-        file_size = os.path.getsize(output_path)
+        # Find the downloaded file, off the event loop since the disk may be busy
+        output_path, file_size = await asyncio.to_thread(find_downloaded_file, temp_dir)
 
         # Check if the file exceeds the local API server limit
         if file_size > MAX_FILE_SIZE:
             raise Exception(f"File size ({file_size / (1024 * 1024):.1f}MB) exceeds the 2GB limit.")
 
-        # Update info message if provided
-        if info_message:
-            current_text = await get_message_text(info_message)
-            if "Uploading" not in current_text:
-                await update_info_message(info_message,
-                                          f"{current_text}\nUploading {progress_label} ({file_size / (1024 * 1024):.1f}MB)...")
+        return DownloadedFile(output_path, file_size, VideoMeta.from_info(info, "video"), temp)
 
-        # Send the file
-        if quality == "audio":
-            await context.bot.send_audio(
-                chat_id=chat_id,
-                audio=open(output_path, "rb"),
-                caption=f"{video_title} {progress_label} (Audio)",
-                title=video_title,
-                performer=info.get("uploader", "Unknown"),
-                duration=info.get("duration", None),
-            )
+    except BaseException as e:
+        if isinstance(e, asyncio.CancelledError):
+            # Stop the yt-dlp worker at its next hook instead of letting it run to the end
+            cancel_event.set()
+        # Clean up temporary files, once a canceled yt-dlp call has stopped writing to them
+        if download_future is not None and not download_future.done():
+            download_future.add_done_callback(lambda _: _cleanup_executor.submit(temp.cleanup))
         else:
-            # Convert quality to integer for width/height parameters
-            resolution = int(quality) if quality != "audio" else None
+            cleanup_in_background(temp)
+        raise
 
-            await context.bot.send_video(
-                chat_id=chat_id,
-                video=open(output_path, "rb"),
-                caption=f"{video_title} {progress_label} ({quality}p)",
-                supports_streaming=True,
-                duration=info.get("duration", None),
-                width=resolution,
-                height=resolution,
-            )
 
-        # Update info message after successful send
-        if info_message:
-            current_text = await get_message_text(info_message)
-            updated_text = current_text.replace(
-                f"Uploading {progress_label}",
-                f"✅ Completed {progress_label}"
-            )
-            await update_info_message(info_message, updated_text)
+async def queue_download(*args):
+    """Run download_file() on the shared worker pool and wait for its DownloadedFile"""
+    future = asyncio.get_running_loop().create_future()
+    await _download_queue.put((future, args))
+    return await future
+
+
+async def download_worker():
+    """Take download jobs off the shared queue one at a time"""
+    while True:
+        future, args = await _download_queue.get()
+        try:
+            if future.cancelled():
+                continue  # The requester gave up while the job was still queued
+
+            task = asyncio.create_task(download_file(*args))
+            # Canceling the waiting requester cancels the download itself
+            future.add_done_callback(lambda f, task=task: task.cancel() if f.cancelled() else None)
+            await asyncio.wait({task})
+
+            if future.cancelled():
+                if not task.cancelled() and task.exception() is None:
+                    task.result().cleanup()  # Finished just as it was canceled, nobody will send it
+            elif task.cancelled():
+                future.cancel()
+            elif task.exception() is not None:
+                future.set_exception(task.exception())
+            else:
+                future.set_result(task.result())
+        finally:
+            _download_queue.task_done()
+
+
+async def cleanup_worker():
+    """Remove queued temp dirs one at a time on a worker thread"""
+    while True:
+        temp = await _cleanup_queue.get()
+        try:
+            await asyncio.get_running_loop().run_in_executor(_cleanup_executor, temp.cleanup)
+        finally:
+            _cleanup_queue.task_done()
+
+
+async def start_workers(application):
+    """Start the download and cleanup workers once the event loop is running"""
+    _workers.extend(asyncio.create_task(download_worker()) for _ in range(DOWNLOAD_WORKERS))
+    _workers.extend(asyncio.create_task(cleanup_worker()) for _ in range(CLEANUP_WORKERS))
+
+
+async def stop_workers(application):
+    """Cancel the workers on shutdown, after removing the temp dirs still queued"""
+    await _cleanup_queue.join()
+    for worker in _workers:
+        worker.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
+
+
+async def download_and_send_video(context, chat_id, quality, url, progress_label, progress=None,
+                                  cancel_event=None):
+    """Download and send a single video or audio file"""
+    cancel_event = cancel_event or threading.Event()
+    file = None
+
+    try:
+        file = await queue_download(quality, url, progress_label, progress, cancel_event)
+
+        # Update progress message if provided
+        if progress:
+            progress.update(progress_label, STATUS_UPLOADING % (progress_label, file.size / (1024 * 1024)))
+
+        await send_file(context, chat_id, quality, file, progress_label)
+
+        # Update progress message after successful send
+        if progress:
+            progress.update(progress_label, STATUS_COMPLETED % progress_label)
 
         return True
 
+    except asyncio.CancelledError:
+        logger.info(f"Download canceled ({progress_label})")
+        cancel_event.set()
+
+        if progress:
+            progress.update(progress_label, STATUS_CANCELED % progress_label)
+
+        return False
     except Exception as e:
         logger.error(f"Download error ({progress_label}): {e}")
 
-        # Update info message with error
-        if info_message:
-            current_text = await get_message_text(info_message)
-            updated_text = current_text.replace(
-                f"Downloading {progress_label}...",
-                f"❌ Failed {progress_label}: {str(e)[:50]}"
-            ).replace(
-                f"Uploading {progress_label}",
-                f"❌ Failed {progress_label}: {str(e)[:50]}"
-            )
-            await update_info_message(info_message, updated_text)
+        # Update progress message with error
+        if progress:
+            progress.update(progress_label, STATUS_FAILED % (progress_label, e))
 
         return False
     finally:
-        # Clean up temporary files
-        cleanup_temp_files(temp_dir)
+        if file:
+            file.cleanup()
 
 
 async def handle_quality_selection(update: Update, context: ContextTypes.DEFAULT_TYPE, quality, url,
@@ -723,101 +1101,231 @@ async def handle_quality_selection(update: Update, context: ContextTypes.DEFAULT
 
     if not is_playlist:
         try:
-            # For messages with photos, we need to edit caption instead
-            if hasattr(original_message, 'photo') and original_message.photo:
-                await original_message.edit_caption(caption=status_text)
-            else:
-                await original_message.edit_text(status_text)
-        except Exception as e:
+            await edit_status_message(original_message, status_text)
+        except BadRequest as e:
             logger.error(f"Error editing message: {e}")
-            # If editing fails, send a new message
+            # The menu can't be edited (deleted or too old), send a new message
             status_message = await context.bot.send_message(
                 chat_id=chat_id,
                 text=status_text
             )
+        except (RetryAfter, NetworkError) as e:
+            # A new message would hit the same flood limit or network, progress edits retry later
+            logger.warning(f"Error editing message: {e}")
     else:
         try:
-            await status_message.edit_text(status_text)
-        except Exception as e:
+            await edit_status_message(status_message, status_text)
+        except (BadRequest, RetryAfter, NetworkError) as e:
             logger.error(f"Error updating playlist message: {e}")
 
-    # Use the download_and_send_video function
+    # Run the download as a tracked task so /cancel can abort it
     progress_label = playlist_progress if playlist_progress else ""
-    success = await download_and_send_video(context, chat_id, quality, url, progress_label, status_message)
+    progress = ProgressMessage(status_message, status_text)
+    success = await run_cancelable(
+        context, download_and_send_video(context, chat_id, quality, url, progress_label, progress)
+    )
 
-    # Update completion message for single video downloads
+    # Update completion message for single video downloads, otherwise show the final status now
     if not is_playlist and success:
-        completion_text = "✅ Download complete!"
-        try:
-            if hasattr(original_message, 'photo') and original_message.photo:
-                await original_message.edit_caption(caption=completion_text)
-            else:
-                await status_message.edit_text(completion_text)
-        except Exception as e:
-            logger.error(f"Error updating completion message: {e}")
+        await progress.finish("✅ Download complete!")
+    else:
+        await progress.flush()
 
 
-async def get_message_text(message):
-    """Get message text safely"""
+async def run_cancelable(context, coro):
+    """Run a download as a task /cancel can find in chat_data, returns None if it was canceled"""
+    task = asyncio.create_task(coro)
+    # Every running download of the chat, so a second one doesn't hide the first from /cancel
+    downloads = context.chat_data.setdefault('downloads', set())
+    downloads.add(task)
     try:
-        if isinstance(message, Message):
-            return message.text or ""
-        return ""
-    except Exception:
-        return ""
+        return await task
+    except asyncio.CancelledError:
+        if asyncio.current_task().cancelling():
+            raise  # The handler itself is being canceled, not just the download
+        return None
+    finally:
+        downloads.discard(task)
 
 
-async def update_info_message(message, new_text):
-    """Update info message safely"""
+def parse_youtube_url(url):
+    """Return the parsed URL if it is a YouTube video or playlist link, otherwise None"""
+    if any(c.isspace() for c in url):
+        return None
     try:
-        if isinstance(message, Message):
-            await message.edit_text(new_text)
-        else:
-            logger.warning(f"Expected Message object, got {type(message)}")
-    except Exception as e:
-        logger.error(f"Error updating info message: {e}")
+        parsed = urlparse(url if "//" in url else f"//{url}")
+    except ValueError:  # e.g. an unbalanced "[" in the host ("Invalid IPv6 URL")
+        return None
+    if parsed.scheme not in ("", "http", "https"):
+        return None
+
+    host = (parsed.hostname or "").removeprefix("www.").removeprefix("m.")
+    if host not in YOUTUBE_HOSTS:
+        return None
+
+    # youtu.be/<id>
+    if host == "youtu.be":
+        video_id = parsed.path[1:].split("/", 1)[0]
+        return parsed if VIDEO_ID_RE.fullmatch(video_id) else None
+
+    # youtube.com/watch?v=<id> and youtube.com/playlist?list=<id>
+    query = parse_qs(parsed.query)
+    if "v" in query:
+        return parsed if VIDEO_ID_RE.fullmatch(query["v"][0]) else None
+    if query.get("list", [""])[0]:
+        return parsed
+
+    # youtube.com/embed/<id>, /live/<id>, /v/<id>, /shorts/<id>
+    for prefix in YOUTUBE_ID_PATHS:
+        if parsed.path.startswith(prefix):
+            video_id = parsed.path[len(prefix):].split("/", 1)[0]
+            return parsed if VIDEO_ID_RE.fullmatch(video_id) else None
+    return None
+
+
+def get_info_ydl(profile):
+    """Return the reusable YoutubeDL instance for a metadata profile"""
+    instances = getattr(_ydl_local, "instances", None)
+    if instances is None:
+        instances = _ydl_local.instances = {}
+    if profile not in instances:
+        instances[profile] = YoutubeDL(INFO_YDL_OPTS[profile])
+    return instances[profile]
+
+
+def extract_info_sync(url, profile):
+    """Extract metadata with a shared YoutubeDL instance (blocking)"""
+    return get_info_ydl(profile).extract_info(url, download=False)
+
+
+def download_sync(url, ydl_opts, info=None):
+    """Download a video with yt-dlp and return its info dict (blocking)"""
+    with YoutubeDL(ydl_opts) as ydl:
+        if info is not None:
+            # Reuse the quality menu's full extraction ("video" profile, cached for INFO_CACHE_TTL
+            # so its format URLs are still valid), only format selection and download remain
+            return ydl.process_ie_result(ydl.sanitize_info(info, remove_private_keys=True), download=True)
+        return ydl.extract_info(url, download=True)
+
+
+def find_downloaded_file(directory):
+    """Return the path and size of the file yt-dlp left in a directory (blocking)"""
+    with os.scandir(directory) as it:
+        entry = next(it, None)
+        if entry is None:
+            raise Exception("No files were downloaded")
+        return entry.path, entry.stat().st_size
+
+
+def cleanup_in_background(temp):
+    """Queue a TemporaryDirectory for removal, deleting a 2GB file can stall the event loop"""
+    _cleanup_queue.put_nowait(temp)
+
+
+async def run_ydl(func, *args):
+    """Run a blocking yt-dlp call on the bounded worker pool"""
+    return await asyncio.get_running_loop().run_in_executor(_ydl_executor, func, *args)
+
+
+def register_url(context, url):
+    """Remember a URL for this chat and return the short ID inline buttons refer to it by"""
+    url_id = hashlib.blake2b(url.encode(), digest_size=4).hexdigest()  # Short ID, stable per URL
+    if 'urls' not in context.chat_data:
+        context.chat_data['urls'] = TTLCache(CHAT_URL_CACHE_SIZE, CHAT_URL_TTL)
+    context.chat_data['urls'][url_id] = url
+    return url_id
+
 
+async def cached_extract(url, profile):
+    """Extract metadata for a profile, serving repeats from the in-memory cache"""
+    key = (profile, url)
+    info = _info_cache.get(key)
+    if info is None:
+        info = await run_ydl(extract_info_sync, url, profile)
+        if info:
+            _info_cache[key] = info
+    return info
 
-def cleanup_temp_files(directory):
-    """Clean up temporary files and directories"""
+
+async def edit_status_message(message, text):
+    """Edit a status message's caption (photo) or text, ignoring "message is not modified" errors"""
+    # For messages with photos, we need to edit caption instead
+    edit = message.edit_caption if message.photo else message.edit_text
     try:
-        if os.path.exists(directory):
-            for filename in os.listdir(directory):
-                file_path = os.path.join(directory, filename)
-                try:
-                    if os.path.isfile(file_path):
-                        os.unlink(file_path)
-                except Exception as e:
-                    logger.error(f"Error deleting {file_path}: {e}")
-            os.rmdir(directory)
-    except Exception as e:
-        logger.error(f"Error cleaning up directory {directory}: {e}")
+        await edit(text)
+    except BadRequest as e:
+        if "not modified" not in str(e):
+            raise
+
 
+@lru_cache(maxsize=1024)
 def format_duration(seconds):
     """Format seconds into hours:minutes:seconds"""
-    hours, remainder = divmod(seconds, 3600)
+    hours, remainder = divmod(int(seconds or 0), 3600)
     minutes, seconds = divmod(remainder, 60)
-
-    if hours:
-        return f"{int(hours)}:{int(minutes):02d}:{int(seconds):02d}"
-    else:
-        return f"{int(minutes):02d}:{int(seconds):02d}"
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes:02d}:{seconds:02d}"
 
 
 def main():
     """Start the bot"""
+    if DOWNLOAD_DIR:
+        os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+
+    # Keep-alive connection pool sized for concurrent sends/edits; the local server is on
+    # localhost so connecting fails fast, while uploads get generous read/write timeouts and
+    # bursts of progress edits wait for a free connection instead of failing
+    request = HTTPXRequest(
+        connection_pool_size=256,
+        connect_timeout=1,
+        read_timeout=300,
+        write_timeout=600,
+        pool_timeout=30,
+    )
+
     # Create the Application with local API server
-    application = Application.builder().token(TOKEN).base_url(LOCAL_API_SERVER).build()
+    # local_mode lets the server read uploads straight from disk instead of a multipart upload
+    application = (
+        Application.builder()
+        .token(TOKEN)
+        .base_url(LOCAL_API_SERVER)
+        .local_mode(True)
+        .request(request)
+        # Queue calls under Telegram's flood limits and retry on RetryAfter instead of failing
+        .rate_limiter(AIORateLimiter(
+            overall_max_rate=30,
+            overall_time_period=1,
+            group_max_rate=20,
+            group_time_period=60,
+            max_retries=3,
+        ))
+        .post_init(start_workers)
+        .post_shutdown(stop_workers)
+        .build()
+    )
 
     # Add handlers
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("cancel", cancel_command))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_url))
-    application.add_handler(CallbackQueryHandler(callback_query_handler))
+    # Downloads run for minutes, so these handlers run as their own tasks instead of holding up
+    # every later update (including /cancel) until they finish
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_url, block=False))
+    application.add_handler(CallbackQueryHandler(callback_query_handler, block=False))
 
     # Start the Bot
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    # Only subscribe to the update types the handlers above consume
+    allowed_updates = [Update.MESSAGE, Update.CALLBACK_QUERY]
+    if WEBHOOK_URL:
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=urlparse(WEBHOOK_URL).path.lstrip("/"),
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=allowed_updates,
+        )
+    else:
+        application.run_polling(allowed_updates=allowed_updates)
 
 
 if __name__ == "__main__":